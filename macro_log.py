@@ -3,32 +3,30 @@
 # Copyright (C) 2024 Anonoei <dev@anonoei.com>
 #
 # This file may be distributed under the terms of the MIT license.
-from enum import Enum
+from enum import IntEnum
+import atexit
+import collections
 import logging
-import queue
+import logging.handlers
 import threading
 import os
 
-class Level(Enum):
+class Level(IntEnum):
     TRACE = 0
     DEBUG = 1
     INFO = 2
     WARN = 3
     ERROR = 5
 
-    def __lt__(self, other):
-        return self.value < other.value
-    def __le__(self, other):
-        return self.value <= other.value
-    def __gt__(self, other):
-        return self.value > other.value
-    def __ge__(self, other):
-        return self.value >= other.value
-    
+_LEVEL_BY_NAME = {l.name: l for l in Level}
+_LEVEL_PREFIX = {l: f"{l.name} [" for l in Level}
+
 class LogVars:
+    __slots__ = ('level', 'level_value', 'level_prefix', 'name', 'msg', 'display', 'notify')
+
     @staticmethod
     def parse(gcmd, level):
-        name = gcmd.get('NAME', None)
+        name = gcmd.get('NAME', '')
         msg = gcmd.get('MSG')
         display = gcmd.get_int('DISPLAY', 0)
         notify = gcmd.get_int('NOTIFY', 0)
@@ -36,52 +34,130 @@ class LogVars:
 
     def __init__(self, level: Level, name: str, msg: str, display: bool = False, notify: bool = False):
         self.level = level
+        self.level_value = level.value if level is not None else -1
+        self.level_prefix = _LEVEL_PREFIX[level] if level is not None else ''
         self.name = name
         self.msg = msg
         self.display = display
         self.notify = notify
 
 # Forward all messages through a queue (polled by background thread)
+# Records are formatted by the background thread, not the caller
 class QueueHandler(logging.Handler):
-    def __init__(self, queue):
+    def __init__(self, listener):
         logging.Handler.__init__(self)
-        self.queue = queue
+        self.listener = listener
+        self.queue = listener.bg_queue
+        self._wake = listener.bg_wake
 
+    # deque.append cannot fail, formatting errors surface on the listener
     def emit(self, record):
-        try:
-            self.format(record)
-            record.msg = record.message
-            record.args = None
-            record.exc_info = None
-            self.queue.put_nowait(record)
-        except Exception:
-            self.handleError(record)
-
-# Poll log queue on background thread and log each message to logfile
-class QueueListener(logging.handlers.TimedRotatingFileHandler):
-    def __init__(self, filename):
-        logging.handlers.TimedRotatingFileHandler.__init__(self, filename, when='midnight', backupCount=5)
-        self.bg_queue = queue.Queue()
+        # A full deque evicts its oldest record on append, count it
+        # Not atomic with the listener's popleft, so this may overcount
+        if len(self.queue) >= self.queue.maxlen:
+            self.listener.dropped += 1
+        self.queue.append(record)
+        self._wake.set()
+
+# Poll log queue on background thread and pass each message to handler
+# Single producer/single consumer: deque append/popleft are thread-safe
+# The deque is bounded, under a log storm the oldest records are dropped
+# dropped is only written by the producer, _reported only by the consumer
+class QueueListener:
+    def __init__(self, handler, maxlen=16384):
+        self.handler = handler
+        self.bg_queue = collections.deque(maxlen=maxlen)
+        self.bg_wake = threading.Event()
+        self.dropped = 0
+        self._reported = 0
+        self._stopping = False
+        self._stopped = False
+        self._closed = False
         self.bg_thread = threading.Thread(target=self._bg_thread)
+        self.bg_thread.daemon = True
         self.bg_thread.start()
 
     def _bg_thread(self):
         while True:
-            record = self.bg_queue.get(True)
-            if record is None:
+            self.bg_wake.wait()
+            self.bg_wake.clear()
+            # Read before draining so records queued ahead of stop() are written
+            stopping = self._stopping
+            # Drain everything queued since the last wakeup
+            batch = []
+            while self.bg_queue:
+                batch.append(self.bg_queue.popleft())
+            dropped = self.dropped - self._reported
+            if dropped:
+                self._reported += dropped
+                # Report the gap where the dropped records would have been
+                batch.insert(0, logging.makeLogRecord({
+                    'name': 'ML', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': "MACRO_LOG: Dropped %i records, log queue full",
+                    'args': (dropped,)}))
+            self._write(batch)
+            if stopping:
                 break
-            self.handle(record)
+        # Closed here, stop() may give up waiting while a backlog drains
+        self._closed = True
+        self.handler.close()
+
+    # Format a batch of records and write them with a single write/flush
+    # Mirrors handler.handle() for each record, as done by the stdlib:
+    # BaseRotatingHandler.emit (rollover check), FileHandler.emit (reopen
+    # a dropped stream) and StreamHandler.emit (write + terminator, flush)
+    def _write(self, batch):
+        handler = self.handler
+        lines = []
+        last = None
+        for record in batch:
+            try:
+                lines.append(handler.format(record) + handler.terminator)
+                last = record
+            except Exception:
+                handler.handleError(record)
+        if lines:
+            handler.acquire()
+            try:
+                # A failed rollover is reported but the batch is still written,
+                # the per-record path would only lose the record that rolled over
+                try:
+                    if handler.shouldRollover(last):
+                        handler.doRollover()
+                except Exception:
+                    handler.handleError(last)
+                # A failed rollover leaves stream as None, reopen it unless
+                # the handler has been closed by this listener
+                if handler.stream is None and not self._closed:
+                    handler.stream = handler._open()
+                if handler.stream is not None:
+                    handler.stream.write("".join(lines))
+                    handler.stream.flush()
+            except Exception:
+                handler.handleError(last)
+            finally:
+                handler.release()
 
     def stop(self):
-        self.bg_queue.put_nowait(None)
-        self.bg_thread.join()
+        if self._stopped:
+            return
+        self._stopped = True
+        # Signal through a flag, a sentinel could evict a queued record
+        self._stopping = True
+        self.bg_wake.set()
+        self.bg_thread.join(timeout=2.0)
 
 # Class to improve formatting of multi-line messages
 class MultiLineFormatter(logging.Formatter):
+    def __init__(self, *args, **kwargs):
+        super(MultiLineFormatter, self).__init__(*args, **kwargs)
+        self._indent_nl = '\n' + ' ' * 9
+
     def format(self, record):
-        indent = ' ' * 9
         lines = super(MultiLineFormatter, self).format(record)
-        return lines.replace('\n', '\n' + indent)
+        if '\n' not in lines:
+            return lines
+        return lines.replace('\n', self._indent_nl)
 
 class MacroLog:
     def __init__(self, config):
@@ -92,22 +168,45 @@ class MacroLog:
         self.printer.register_event_handler('klippy:connect', self.handle_connect)
         self.printer.register_event_handler("klippy:disconnect", self.handle_disconnect)
 
-        self.log_level = config.getint('log_level', 2, minval=0, maxval=4)
-        self.log_file_level = config.getint('log_file_level', 0, minval=0, maxval=4)
+        log_level = config.getint('log_level', 2, minval=0, maxval=5)
+        log_file_level = config.getint('log_file_level', 0, minval=0, maxval=5)
         self.log_format = config.get('format', '%(asctime)s %(message)s')
         self.log_date_format = config.get('date_format', '%H:%M:%S')
 
-        for lvl in Level:
-            if self.log_level == lvl.value:
-                self.log_level = lvl
-            if self.log_file_level == lvl.value:
-                self.log_file_level = lvl
+        try:
+            self.log_level = Level(log_level)
+            self.log_file_level = Level(log_file_level)
+        except ValueError as e:
+            raise config.error(f"[macro_log] {e}, valid levels are 0-3 and 5")
+        # Integer thresholds, compared on every log call
+        self._lvl_int = self.log_level.value
+        self._file_lvl_int = self.log_file_level.value
+
+        # Place ml.log next to klippy.log, resolved once
+        logfile_path = self.printer.start_args.get('log_file')
+        dirname = os.path.dirname(logfile_path) if logfile_path else ''
+        if not dirname:
+            self.ml_filepath = '/tmp/ml.log'
+        else:
+            self.ml_filepath = os.path.join(dirname, 'ml.log')
 
         self.queue_listener = None
+        self.queue_handler = None
         self.logger = None
+        self.display_status = None
 
         self.gcode = self.printer.lookup_object('gcode')
 
+        # Bind references used on every logging gcmd
+        self._parse = LogVars.parse
+        self._lvl_trace = Level.TRACE
+        self._lvl_debug = Level.DEBUG
+        self._lvl_info = Level.INFO
+        self._lvl_warn = Level.WARN
+        self._lvl_error = Level.ERROR
+        self._respond = self.gcode.respond_info
+        self._respond_err = self.gcode._respond_error
+
         self.gcode.register_command('_LOG', self.cmd_LOG, desc=self.cmd_LOG_help)
         self.gcode.register_command('_TRACE', self.cmd_TRACE, desc=self.cmd_TRACE_help)
         self.gcode.register_command('_DEBUG', self.cmd_DEBUG, desc=self.cmd_DEBUG_help)
@@ -116,85 +215,125 @@ class MacroLog:
         self.gcode.register_command('_ERROR', self.cmd_ERROR, desc=self.cmd_ERROR_help)
         self.gcode.register_command('_PRINT', self.cmd_PRINT, desc=self.cmd_PRINT_help)
 
+    # Whether a message at lvl_int would reach any sink
+    def _enabled(self, lvl_int, gcmd):
+        if self._file_lvl_int <= lvl_int or self._lvl_int <= lvl_int:
+            return True
+        return bool(gcmd.get_int('DISPLAY', 0))
+
     def _log(self, lv: LogVars):
         if lv.level is None:
-            message = f"{lv.name}: {lv.msg}"
-            self.logger.info(message)
+            emit_file = emit_resp = True
+            # No NAME, print the bare message rather than ': msg'
+            sep = ": " if lv.name else ""
         else:
-            message = f"{lv.level.name} [{lv.name}]: {lv.msg}"
-            if self.log_file_level <= lv.level:
-                self.logger.info(message)
+            emit_file = self._file_lvl_int <= lv.level_value
+            emit_resp = self._lvl_int <= lv.level_value
+            # Nothing consumes this message, skip formatting it
+            if not (emit_file or emit_resp or lv.display):
+                return
+            sep = "]: "
+
+        # Formatted by the background thread when the record is written
+        if emit_file and self.logger is not None:
+            self.logger.info("%s%s%s%s", lv.level_prefix, lv.name, sep, lv.msg)
+
+        if not (emit_resp or lv.display):
+            return
+        message = lv.level_prefix + lv.name + sep + lv.msg
 
         if lv.display:
-            self.gcode._process_commands([f"SET_DISPLAY_TEXT MSG=\"{message}\""], False)
+            if self.display_status is not None:
+                # Same effect as SET_DISPLAY_TEXT without parsing a gcode line
+                self.display_status.message = message
+            else:
+                self.gcode._process_commands([f"SET_DISPLAY_TEXT MSG=\"{message}\""], False)
 
-        if lv.level is None or self.log_level <= lv.level:
+        if emit_resp:
             if lv.notify:
                 message = f"MR_NOTIFY | {message}"
-            if lv.level == Level.ERROR:
-                self.gcode._respond_error(message)
+            if lv.level_value == Level.ERROR:
+                self._respond_err(message)
                 return
-            self.gcode.respond_info(message)
+            self._respond(message)
 
     def handle_connect(self):
+        self.display_status = self.printer.lookup_object('display_status', None)
         self._setup_logging()
 
     def handle_disconnect(self):
         self._log(LogVars(Level.TRACE, "ML", "Disconnecting"))
+        self.shutdown()
+
+    # Flush and stop background logging, safe to call more than once
+    def shutdown(self):
+        if self.queue_listener is None:
+            return
+        ql, self.queue_listener = self.queue_listener, None
+        atexit.unregister(self.shutdown)
+        # The 'ML' logger outlives klipper restarts, detach our handler
+        self.logger.removeHandler(self.queue_handler)
+        self.queue_handler = None
+        self.logger = None
+        ql.stop()
 
     def _setup_logging(self):
         # Setup background file based logging before logging any messages
-        if self.log_file_level >= Level.TRACE:
-            logfile_path = self.printer.start_args['log_file']
-            dirname = os.path.dirname(logfile_path)
-            if dirname is None:
-                ml_filepath = '/tmp/ml.log'
-            else:
-                ml_filepath = dirname + '/ml.log'
-            self.queue_listener = QueueListener(ml_filepath)
-            self.queue_listener.setFormatter(MultiLineFormatter(self.log_format, datefmt=self.log_date_format))
-            queue_handler = QueueHandler(self.queue_listener.bg_queue)
+        if self._file_lvl_int >= Level.TRACE:
+            ml_filepath = self.ml_filepath
+            file_handler = logging.handlers.TimedRotatingFileHandler(ml_filepath, when='midnight', backupCount=5)
+            file_handler.setFormatter(MultiLineFormatter(self.log_format, datefmt=self.log_date_format))
+            self.queue_listener = QueueListener(file_handler)
+            atexit.register(self.shutdown)
+            self.queue_handler = QueueHandler(self.queue_listener)
             self.logger = logging.getLogger('ML')
             self.logger.setLevel(logging.NOTSET)
-            self.logger.addHandler(queue_handler)
+            # Keep macro logs out of klippy.log and the root handlers
+            self.logger.propagate = False
+            self.logger.addHandler(self.queue_handler)
             self._log(LogVars(None, "MACRO_LOG", f"\n ----- Initializing with {ml_filepath = } ----- "))
             self._log(LogVars(None, "MACRO_LOG", f"\\--> Using level: {self.log_level.name}, file_level: {self.log_file_level.name} "))
 
     cmd_LOG_help = ("")
     def cmd_LOG(self, gcmd):
-        lvl = gcmd.get('LVL', None)
-        if lvl is not None:
-            lvl = lvl.upper()
-            for l in Level:
-                if l.name == lvl:
-                    lvl = l
+        raw = gcmd.get('LVL', None)
+        lvl = None
+        if raw:
+            lvl = _LEVEL_BY_NAME.get(raw.upper())
             if lvl is None:
-                self._log(LogVars(None, "MACRO_LOG", f"Failed to find log level from {lvl}"))
+                self._log(LogVars(None, "MACRO_LOG", f"Failed to find log level from {raw}"))
+                return
+            if not self._enabled(lvl, gcmd):
                 return
-        self._log(LogVars.parse(gcmd, lvl))
+        self._log(self._parse(gcmd, lvl))
     cmd_TRACE_help = ("")
     def cmd_TRACE(self, gcmd):
-        self._log(LogVars.parse(gcmd, Level.TRACE))
+        if self._enabled(self._lvl_trace, gcmd):
+            self._log(self._parse(gcmd, self._lvl_trace))
 
     cmd_DEBUG_help = ("")
     def cmd_DEBUG(self, gcmd):
-        self._log(LogVars.parse(gcmd, Level.DEBUG))
+        if self._enabled(self._lvl_debug, gcmd):
+            self._log(self._parse(gcmd, self._lvl_debug))
 
     cmd_INFO_help = ("")
     def cmd_INFO(self, gcmd):
-        self._log(LogVars.parse(gcmd, Level.INFO))
+        if self._enabled(self._lvl_info, gcmd):
+            self._log(self._parse(gcmd, self._lvl_info))
 
     cmd_WARN_help = ("")
     def cmd_WARN(self, gcmd):
-        self._log(LogVars.parse(gcmd, Level.WARN))
+        if self._enabled(self._lvl_warn, gcmd):
+            self._log(self._parse(gcmd, self._lvl_warn))
 
     cmd_ERROR_help = ("")
     def cmd_ERROR(self, gcmd):
-        self._log(LogVars.parse(gcmd, Level.ERROR))
+        if self._enabled(self._lvl_error, gcmd):
+            self._log(self._parse(gcmd, self._lvl_error))
 
     cmd_PRINT_help = ("")
     def cmd_PRINT(self, gcmd):
-        self._log(LogVars.parse(gcmd, None))
+        self._log(self._parse(gcmd, None))
 
 def load_config(config): # Called by klipper from [macro_log]
     return MacroLog(config)
\ No newline at end of file